@@ -1,23 +1,49 @@
 #!/usr/bin/env python3
 
-import re
 import os
-import argparse
-from enum import Enum
-from tocsic_utils import static_vars
+import sys
+import mmap
+from itertools import chain
+from typing import TYPE_CHECKING, Final, Iterator, Optional, Tuple
+
+if TYPE_CHECKING:
+    import re
+
+USAGE = 'usage: tocsic.py [-h] [-c CLEAN] [-o OUTPUT] filename'
+HELP = USAGE + '''
+
+positional arguments:
+  filename             path to Markdown document
+
+options:
+  -h, --help           show this help message and exit
+  -c, --clean CLEAN    remove table of contents if present
+  -o, --output OUTPUT  output file
+'''
+
+to_underscore_regex: Optional['re.Pattern[str]'] = None
+non_alnum_regex: Optional['re.Pattern[str]'] = None
+keyword_regex: Optional['re.Pattern[str]'] = None
+
+
+def compile_patterns() -> None:
+    ''' Compile the shared patterns on first use: importing re is deferred so
+        invocations that exit before processing a file never pay for it '''
+    global to_underscore_regex, non_alnum_regex, keyword_regex
+    if keyword_regex is None:
+        import re
+        to_underscore_regex = re.compile(r'[ -/]+')
+        non_alnum_regex = re.compile(r'[^\w]')
+        # All three patterns stay Unicode-aware on purpose: header_to_link
+        # emits non-ASCII ids for non-ASCII titles (\w in non_alnum_regex
+        # keeps them), and keyword_regex must recognize those same ids when
+        # the tool is re-run on its own output.
+        keyword_regex = re.compile(r'<a +id="([\w-]+)"></a>')
 
 
 class Tocsic:
-    toc_marker = '# Table of Contents'
-
-    head_regex = re.compile(r'(#+)\s*(\S+(?:\s+\S+)*)')
-    keyword_regex = re.compile(r'\s*<a +id="([\w-]+)"></a>')
-
-    class BodyState(Enum):
-        BODY = 1
-        FOUND_LINK = 2
-        FOUND_HEADER = 3
-        IN_CODE_BLOCK = 4
+    toc_marker: Final = '# Table of Contents'
+    toc_marker_bytes: Final = toc_marker.encode('utf-8')
 
     def __init__(self):
         self.args = None
@@ -29,28 +55,64 @@ class Tocsic:
         self.make_arguments()
         self.check_arguments()
 
-        self.toc_info = []
-        self.toc = Tocsic.toc_marker + '\n'
-        self.body = ''
+        self.toc_parts = [Tocsic.toc_marker_bytes + b'\n']
+        self.toc_indents = ['']
+        self.body_parts = []
 
         self.header_dict = dict()
 
         try:
-            self.file = open(self.input_file, 'r')
+            self.file = open(self.input_file, 'rb')
         except IOError:
             raise TocsicException('Failed to open file ' + self.input_file)
 
         self.is_valid = True
 
     def make_arguments(self):
-        arg_parser = argparse.ArgumentParser()
-        arg_parser.add_argument('filename', type=str, help='path to Markdown document')
-        arg_parser.add_argument('-c', '--clean', help='remove table of contents if present')
-        arg_parser.add_argument('-o', '--output', type=str, help='output file', default=None)
+        # argparse pulls in gettext and friends at import time, which dominates
+        # total runtime on small documents; the few options here are simple
+        # enough to parse by hand.
         # TODO: add an option for handling empty header names
         # TODO: add an option for handling other keyword formats
         # TODO: add an option for disabling keyword processing
-        self.args = arg_parser.parse_args()
+        self.args = Arguments()
+
+        argv = sys.argv[1:]
+        i = 0
+        while i < len(argv):
+            arg = argv[i]
+            value = None
+
+            # Accept the same spellings argparse did: '--output out.md',
+            # '--output=out.md', '-o out.md' and '-oout.md'.
+            if arg.startswith('--') and '=' in arg:
+                arg, value = arg.split('=', 1)
+            elif len(arg) > 2 and arg[:2] in ('-c', '-o'):
+                arg, value = arg[:2], arg[2:]
+
+            if arg in ('-h', '--help'):
+                print(HELP, end='')
+                sys.exit(0)
+            elif arg in ('-c', '--clean', '-o', '--output'):
+                if value is None:
+                    i += 1
+                    if i == len(argv):
+                        usage_error('argument {}: expected one argument'.format(arg))
+                    value = argv[i]
+                if arg in ('-c', '--clean'):
+                    self.args.clean = value
+                else:
+                    self.args.output = value
+            elif arg.startswith('-') and arg != '-':
+                usage_error('unrecognized arguments: ' + arg)
+            elif self.args.filename is None:
+                self.args.filename = arg
+            else:
+                usage_error('unrecognized arguments: ' + arg)
+            i += 1
+
+        if self.args.filename is None:
+            usage_error('the following arguments are required: filename')
 
     def check_arguments(self):
         md_path = self.args.filename
@@ -70,161 +132,194 @@ class Tocsic:
             self.output_file = self.make_output_name(self.input_file)
 
     @staticmethod
-    def make_output_name(filename):
-        if '.' not in filename:
+    def make_output_name(filename: str) -> str:
+        head, sep, tail = filename.rpartition('.')
+        if not sep:
             return filename + '_toc'
 
-        return '.cot_'.join(filename[::-1].split('.', 1))[::-1]
+        return f'{head}_toc.{tail}'
 
     def add_toc(self):
         if not self.is_valid:
             return
 
-        line_gen = FileReader(self.file)
-        if self.process_start(line_gen):
-            self.process_toc(line_gen)
-        self.process_body(line_gen)
+        compile_patterns()
+
+        # mmap cannot map an empty file, and there is nothing to scan anyway.
+        if os.fstat(self.file.fileno()).st_size > 0:
+            with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                lines = enumerate(iter_lines(mm), 1)
+                first_line = self.process_start(lines)
+                if first_line is not None and first_line[1].strip() == Tocsic.toc_marker_bytes:
+                    first_line = self.process_toc(lines)
+                self.process_body(first_line, lines)
         self.file.close()
         # TODO: add toc error-checking and maybe some postprocessing
 
-        self.make_toc()
         self.generate_md()
 
     @staticmethod
-    def process_start(line_gen):
-        try:
-            line = next(line_gen).strip()
-            while not line:
-                line = next(line_gen).strip()
-
-            line_gen.back()
-            if line == Tocsic.toc_marker:
-                return True
-            else:
-                return False
-        except StopIteration:
-            pass
+    def process_start(lines: Iterator[Tuple[int, bytes]]) -> Optional[Tuple[int, bytes]]:
+        for numbered_line in lines:
+            if numbered_line[1].strip():
+                return numbered_line
+        return None
 
     @staticmethod
-    def process_toc(line_gen):
-        try:
-            line = next(line_gen).strip()
-            while line:
-                line = next(line_gen).strip()
-
-            line_gen.back()
-        except StopIteration:
-            pass
-
-    def process_body(self, line_gen):
-        body_state = Tocsic.BodyState.BODY
-        link_line = ''
-
+    def process_toc(lines: Iterator[Tuple[int, bytes]]) -> Optional[Tuple[int, bytes]]:
+        for numbered_line in lines:
+            if not numbered_line[1].strip():
+                return numbered_line
+        return None
+
+    def process_body(self, first_line: Optional[Tuple[int, bytes]], lines: Iterator[Tuple[int, bytes]]) -> None:
+        if first_line is not None:
+            lines = chain([first_line], lines)
+
+        # Bind the hot attributes to locals once so the loops below use
+        # LOAD_FAST instead of repeated attribute lookups.
+        append_body = self.body_parts.append
+        make_entry = self.make_toc_entry
+        assert keyword_regex is not None  # compiled by add_toc before the scan
+        match_keyword = keyword_regex.match
+        link_id = ''
+
+        # The same state machine as before, but written as one tight loop per
+        # state: the current state is encoded in the program counter, so there
+        # is no per-line state dispatch.
         try:
+            line_num, line = next(lines)
             while True:
-                if body_state == Tocsic.BodyState.BODY:
-                    line = next(line_gen)
-                    if line.startswith('<a'):
-                        link_line = line
-                        body_state = Tocsic.BodyState.FOUND_LINK
-                    elif line.startswith('#'):
+                # BODY state
+                while True:
+                    # Dispatch on the first byte so the ordinary body lines
+                    # (the vast majority) take a single comparison instead of
+                    # three startswith calls.
+                    first_char = line[:1]
+                    if first_char == b'#':
                         # TODO: add support for === and --- style headers
-                        self.make_toc_entry(line, line_gen.line_num, None)
-                        self.body += '<a id="{}"></a>\n'.format(self.toc_info[-1][2])
-                        self.body += line
-                    elif line.startswith('```'):
-                        body_state = Tocsic.BodyState.IN_CODE_BLOCK
-                        self.body += line
+                        link = make_entry(line, line_num, None)
+                        append_body(f'<a id="{link}"></a>\n'.encode('utf-8'))
+                        append_body(line)
+                    elif first_char == b'<' and line.startswith(b'<a'):
+                        # Keyword ids can be any \w run, including non-ASCII
+                        # ones generated by header_to_link, so the rare '<a'
+                        # lines are decoded and matched as str.
+                        match_res = match_keyword(line.decode('utf-8'))
+                        link_id = match_res.group(1) if match_res else ''
+                        break
+                    elif first_char == b'`' and line.startswith(b'```'):
+                        append_body(line)
+                        # IN_CODE_BLOCK state
+                        for line_num, line in lines:
+                            append_body(line)
+                            if line.startswith(b'```'):
+                                break
                     else:
-                        self.body += line
-                elif body_state == Tocsic.BodyState.IN_CODE_BLOCK:
-                    line = next(line_gen)
-                    if line.startswith('```'):
-                        body_state = Tocsic.BodyState.BODY
-                    self.body += line
-                elif body_state == Tocsic.BodyState.FOUND_LINK:
-                    line = next(line_gen)
-                    if line.startswith('<a'):
-                        link_line = line
-                    elif line.startswith('#'):
-                        body_state = Tocsic.BodyState.BODY
-                        self.make_toc_entry(line, line_gen.line_num, link_line)
-                        self.body += '<a id="{}"></a>\n'.format(self.toc_info[-1][2])
-                    elif line.strip() != '':
-                        print('ERROR: There is something between <a> and a header')
-                    self.body += line
+                        append_body(line)
+                    line_num, line = next(lines)
+
+                # FOUND_LINK state
+                while True:
+                    line_num, line = next(lines)
+                    if line.startswith(b'<a'):
+                        match_res = match_keyword(line.decode('utf-8'))
+                        link_id = match_res.group(1) if match_res else ''
+                        append_body(line)
+                    elif line.startswith(b'#'):
+                        link = make_entry(line, line_num, link_id)
+                        append_body(f'<a id="{link}"></a>\n'.encode('utf-8'))
+                        append_body(line)
+                        break
+                    else:
+                        if line.strip() != b'':
+                            print('ERROR: There is something between <a> and a header')
+                        append_body(line)
+
+                line_num, line = next(lines)
         except StopIteration:
             pass
 
-    @static_vars(to_underscore_regex=re.compile(r'[ -/]+'))
-    def header_to_link(self, header):
+    def header_to_link(self, header: str) -> str:
         # TODO: generate correct link name if header contains characters that don't work in links
-        link = re.sub(self.header_to_link.to_underscore_regex, '_', header.lower()).strip('_')
-        link = ''.join(filter(lambda s: str.isalnum(s) or s == '_', link))
-
-        header_cnt = self.header_dict.get(link, 0)
-        if header_cnt == 0:
-            self.header_dict[link] = 1
-            return link
-        else:
-            self.header_dict[link] += 1
-            return link + '_' + str(header_cnt)
-
-    def make_toc_entry(self, line, line_num, keyword_line=None):
-        search_res = re.search(Tocsic.head_regex, line)
-        if not search_res:
+        assert to_underscore_regex is not None and non_alnum_regex is not None
+        link = to_underscore_regex.sub('_', header.lower()).strip('_')
+        link = non_alnum_regex.sub('', link)
+
+        header_dict = self.header_dict
+        header_cnt = header_dict.get(link, 0)
+        header_dict[link] = header_cnt + 1
+        return link if header_cnt == 0 else f'{link}_{header_cnt}'
+
+    def make_toc_entry(self, line: bytes, line_num: int, link_id: Optional[str] = None) -> str:
+        # The scan loop works on raw bytes; lines are only decoded here,
+        # once they are known to contribute to the TOC.
+        text = line.decode('utf-8')
+
+        # Plain string scanning: a run of '#' followed by the title.
+        # C-level string ops here are much cheaper than a regex per header.
+        i = 0
+        n = len(text)
+        while i < n and text[i] == '#':
+            i += 1
+
+        level = i - 1
+        header_name = text[i:].strip()
+        if not header_name:
             raise TocsicException('Line {} starts with "#" but is not a header'.format(line_num))
 
-        header = search_res.groups()
-        level = len(header[0]) - 1
-        header_name = header[1]
-        link = ''
-
-        if keyword_line:
-            search_res = re.search(Tocsic.keyword_regex, keyword_line)
-            if search_res:
-                link = search_res.groups()[0]
+        if link_id is not None:
+            link = link_id
         else:
             link = self.header_to_link(header_name)
 
-        self.toc_info.append((level, header_name, link))
+        # Emit the formatted TOC entry right away instead of collecting
+        # (level, name, link) tuples for a second formatting pass.
+        indents = self.toc_indents
+        while level >= len(indents):
+            indents.append('    ' * len(indents))
+        self.toc_parts.append(f'{indents[level]}1. [{header_name}](#{link})\n'.encode('utf-8'))
+
+        return link
 
-    def make_toc(self):
-        for toc_entry in self.toc_info:
-            self.toc += '{}1. [{}](#{})\n'.format('    ' * toc_entry[0], toc_entry[1], toc_entry[2])
+    def generate_md(self) -> None:
+        with open(self.output_file, 'wb', buffering=1 << 20) as f:
+            f.writelines(self.toc_parts)
+            f.write(b'\n')
+            f.writelines(self.body_parts)
 
-    def generate_md(self):
-        with open(self.output_file, 'w') as f:
-            f.write(self.toc)
-            f.write('\n')
-            f.write(self.body)
+
+class Arguments:
+    def __init__(self):
+        self.filename = None
+        self.clean = None
+        self.output = None
 
 
 class TocsicException(Exception):
     pass
 
 
-class FileReader:
-    def __init__(self, f):
-        self.repeat = False
-        self.last_line = None
-        self.iter = iter(f)
-        self.line_num = 0
+def usage_error(message):
+    print(USAGE, file=sys.stderr)
+    print('tocsic.py: error: ' + message, file=sys.stderr)
+    sys.exit(2)
 
-    def __iter__(self):
-        return self
 
-    def back(self):
-        self.repeat = True
-
-    def __next__(self):
-        if self.repeat:
-            self.repeat = False
-            return self.last_line
-        else:
-            self.last_line = next(self.iter)
-            self.line_num += 1
-            return self.last_line
+def iter_lines(mm: mmap.mmap) -> Iterator[bytes]:
+    ''' Split a memory-mapped file into lines with mmap.find, which scans for
+        the newline at memchr speed instead of paying readline overhead per line '''
+    pos = 0
+    size = len(mm)
+    find = mm.find
+    while pos < size:
+        newline = find(b'\n', pos)
+        if newline == -1:
+            yield mm[pos:]
+            return
+        newline += 1
+        yield mm[pos:newline]
+        pos = newline
 
 
 def is_user_sure(message):